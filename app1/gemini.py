@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import threading
+import time
+
+
+# raised when max_queue calls are already waiting for a free slot
+class QueueFullError(Exception):
+    pass
+
+
+# wraps a gemini GenerativeModel (or any object with a generate_content(prompt, request_options=...) method)
+# identical prompts that are already in flight share one upstream call instead of each firing their own,
+# at most max_concurrency upstream calls run at once and at most max_queue more wait for a slot
+class CoalescingModel:
+
+    def __init__(self, model, max_concurrency=4, timeout=30, max_queue=None):
+        self.model = model
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        # reentrant because add_done_callback runs forget() right away if the call already finished
+        self.lock = threading.RLock()
+        # prompt -> {"future": ..., "waiters": number of callers still waiting on it}
+        self.in_flight = {}
+        # submitted calls that have not finished yet, and how many of those hold a worker
+        self.pending = 0
+        self.running = 0
+        self.counters = {
+            "requests": 0, "issued": 0, "coalesced": 0, "rejected": 0,
+            "timeouts": 0, "cancelled": 0, "failures": 0,
+        }
+
+    def generate_content(self, prompt, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+
+        with self.lock:
+            self.counters["requests"] += 1
+            entry = self.in_flight.get(prompt)
+            if entry is not None:
+                entry["waiters"] += 1
+                self.counters["coalesced"] += 1
+            else:
+                # only calls beyond the max_concurrency slots count as waiting
+                if self.max_queue is not None and self.pending >= self.max_concurrency + self.max_queue:
+                    self.counters["rejected"] += 1
+                    raise QueueFullError("Too many Gemini requests are waiting, try again later.")
+                self.pending += 1
+                future = self.executor.submit(self.call_model, prompt, time.monotonic() + timeout)
+                entry = {"future": future, "waiters": 1}
+                self.in_flight[prompt] = entry
+                self.counters["issued"] += 1
+                future.add_done_callback(lambda done: self.forget(prompt, done))
+
+        # the timeout covers the time spent queued behind other calls as well as the call itself
+        try:
+            return entry["future"].result(timeout=timeout)
+        except FutureTimeout:
+            self.give_up(prompt, entry)
+            raise TimeoutError(f"Gemini did not respond within {timeout} seconds.")
+
+    def call_model(self, prompt, deadline):
+        # the client only gets what is left of the budget after queueing,
+        # so a slot is never held longer than the callers were willing to wait
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Gemini call spent its whole timeout waiting for a free slot.")
+
+        with self.lock:
+            self.running += 1
+        try:
+            return self.model.generate_content(prompt, request_options={"timeout": remaining})
+        except Exception:
+            with self.lock:
+                self.counters["failures"] += 1
+            raise
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def give_up(self, prompt, entry):
+        with self.lock:
+            self.counters["timeouts"] += 1
+            entry["waiters"] -= 1
+            if entry["waiters"] > 0:
+                return
+            # nobody is waiting anymore, don't spend quota (or a slot) on it if it has not started yet
+            if entry["future"].cancel():
+                self.counters["cancelled"] += 1
+            if self.in_flight.get(prompt) is entry:
+                del self.in_flight[prompt]
+
+    # runs once per submitted call, whether it finished, failed or was cancelled
+    def forget(self, prompt, future):
+        # later requests for the same prompt start a fresh call instead of reusing this result
+        with self.lock:
+            self.pending -= 1
+            entry = self.in_flight.get(prompt)
+            if entry is not None and entry["future"] is future:
+                del self.in_flight[prompt]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self.in_flight)
+            stats["running"] = self.running
+            stats["queued"] = self.pending - self.running
+        return stats
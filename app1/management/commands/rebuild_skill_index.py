@@ -0,0 +1,231 @@
+from django.core.management.base import BaseCommand, CommandError
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import faiss
+import hashlib
+import json
+import glob
+import numpy as np
+import os
+import time
+
+
+# app1 directory, where the skills json files and faiss indexes live
+APP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# catalog name -> (metadata json, faiss index) used by the views
+CATALOGS = {
+    "applied": ("applied_skills.json", "applied_faiss_skills_index"),
+    "database": ("database_skills.json", "database_faiss_skills_index"),
+}
+
+# same model HuggingFaceEmbeddings() picks when no model_name is given (used by the views)
+DEFAULT_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+
+INDEX_TYPES = ("flat_l2", "flat_ip", "hnsw")
+
+
+# embeddings model of the current worker process, loaded once per process by _init_worker
+_worker_embeddings = None
+
+
+def _load_embeddings(model_name):
+    # imported here so that listing manage.py commands does not pull in the model libraries
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name)
+
+
+def _init_worker(model_name):
+    global _worker_embeddings
+    _worker_embeddings = _load_embeddings(model_name)
+
+
+def _embed_batch(batch_number, skill_names):
+    # runs inside a pool worker, returns the batch number so results can be put back in order
+    vectors = _worker_embeddings.embed_documents(skill_names)
+    return batch_number, np.array(vectors).astype('float32')
+
+
+def skills_fingerprint(skill_names):
+    return hashlib.sha256(json.dumps(skill_names).encode('utf-8')).hexdigest()
+
+
+def build_index(index_type, dim):
+    if index_type == "flat_l2":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "flat_ip":
+        return faiss.IndexFlatIP(dim)
+    if index_type == "hnsw":
+        return faiss.IndexHNSWFlat(dim, 32)
+    raise CommandError(f"Unknown index type '{index_type}'.")
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the applied or database FAISS skills index from its json metadata. "
+        "Skill names are embedded in batches with embed_documents across a process pool, "
+        "every finished batch is checkpointed so an interrupted run can be resumed with --resume."
+    )
+
+    # the system checks import the url conf and with it app1.views, which loads the embedding model
+    # and the gemini client at import time; the parent process never needs either
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("catalog", choices=sorted(CATALOGS), help="Which skills catalog to rebuild.")
+        parser.add_argument("--batch-size", type=int, default=64, help="Skill names per embed_documents call.")
+        parser.add_argument("--workers", type=int, default=1, help="Number of embedding processes (each loads its own model).")
+        parser.add_argument("--model-name", default=DEFAULT_MODEL_NAME, help="HuggingFace embedding model to use.")
+        parser.add_argument(
+            "--index-type",
+            choices=INDEX_TYPES,
+            default="flat_l2",
+            help="FAISS index type. The views filter on L2 distance, so keep flat_l2 unless migrating them too.",
+        )
+        parser.add_argument("--output", default=None, help="Where to write the index (defaults to the catalog index file).")
+        parser.add_argument("--checkpoint-dir", default=None, help="Directory for batch checkpoints.")
+        parser.add_argument("--resume", action="store_true", help="Reuse batches checkpointed by a previous run.")
+        parser.add_argument("--keep-checkpoints", action="store_true", help="Do not delete checkpoints after a successful rebuild.")
+
+    def handle(self, *args, **options):
+        catalog = options["catalog"]
+        batch_size = options["batch_size"]
+        workers = options["workers"]
+        model_name = options["model_name"]
+
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        if workers < 1:
+            raise CommandError("--workers must be at least 1.")
+
+        skills_file_name, index_file_name = CATALOGS[catalog]
+        skills_file_path = os.path.join(APP_DIR, skills_file_name)
+        index_file = options["output"] or os.path.join(APP_DIR, index_file_name)
+        checkpoint_dir = options["checkpoint_dir"] or os.path.join(APP_DIR, ".rebuild_checkpoints", catalog)
+
+        with open(skills_file_path, 'r') as file:
+            data = json.load(file)
+
+        skill_names = [skill['skill_name'] for skill in data]
+        if not skill_names:
+            raise CommandError(f"No skills found in {skills_file_path}.")
+
+        # the index position of every vector must match the skill position in the json file,
+        # the views map search results back to skills by that position
+        batches = [skill_names[i:i + batch_size] for i in range(0, len(skill_names), batch_size)]
+
+        manifest = {
+            "catalog": catalog,
+            "model_name": model_name,
+            "batch_size": batch_size,
+            "skills_sha256": skills_fingerprint(skill_names),
+        }
+        done = self.prepare_checkpoints(checkpoint_dir, manifest, len(batches), options["resume"])
+        pending = [n for n in range(len(batches)) if n not in done]
+
+        self.stdout.write(
+            f"Rebuilding {catalog} index: {len(skill_names)} skills in {len(batches)} batches "
+            f"({len(done)} already checkpointed), model {model_name}, {workers} worker(s)."
+        )
+
+        start_time = time.time()
+        embedded = 0
+        total = sum(len(batches[n]) for n in pending)
+
+        def save_batch(batch_number, vectors):
+            nonlocal embedded
+            # write then rename, so an interrupted run never leaves a truncated checkpoint behind
+            batch_file = self.batch_path(checkpoint_dir, batch_number)
+            with open(batch_file + ".tmp", 'wb') as file:
+                np.save(file, vectors)
+            os.replace(batch_file + ".tmp", batch_file)
+            embedded += len(vectors)
+            elapsed = time.time() - start_time
+            rate = embedded / elapsed if elapsed > 0 else 0.0
+            self.stdout.write(f"  batch {batch_number + 1}/{len(batches)}: {embedded}/{total} skills, {rate:.1f} skills/s")
+
+        if pending:
+            if workers == 1:
+                # no point paying for a process pool with a single worker
+                _init_worker(model_name)
+                for n in pending:
+                    save_batch(*_embed_batch(n, batches[n]))
+            else:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_name,)) as pool:
+                    futures = [pool.submit(_embed_batch, n, batches[n]) for n in pending]
+                    for future in as_completed(futures):
+                        save_batch(*future.result())
+
+        vectors = np.concatenate([np.load(self.batch_path(checkpoint_dir, n)) for n in range(len(batches))])
+        if len(vectors) != len(skill_names):
+            raise CommandError(f"Checkpoints hold {len(vectors)} vectors for {len(skill_names)} skills, rerun without --resume.")
+
+        index = build_index(options["index_type"], vectors.shape[1])
+        index.add(vectors)
+
+        # write next to the target and swap in, so the views never read a half written index
+        tmp_index_file = index_file + ".tmp"
+        faiss.write_index(index, tmp_index_file)
+
+        # the views keep adding and deleting skills while we embed, swapping in an index built
+        # from an older json would map search results to the wrong (or missing) skills
+        if not options["output"]:
+            with open(skills_file_path, 'r') as file:
+                current_names = [skill['skill_name'] for skill in json.load(file)]
+            if skills_fingerprint(current_names) != manifest["skills_sha256"]:
+                os.remove(tmp_index_file)
+                raise CommandError(
+                    f"{skills_file_path} changed during the rebuild, {index_file} was left untouched. "
+                    "Rerun the command (without --resume)."
+                )
+
+        os.replace(tmp_index_file, index_file)
+
+        if not options["keep_checkpoints"]:
+            self.clear_checkpoints(checkpoint_dir)
+
+        elapsed = time.time() - start_time
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {options['index_type']} index with {index.ntotal} vectors (dim {vectors.shape[1]}) "
+            f"to {index_file} in {elapsed:.1f}s."
+        ))
+
+    def batch_path(self, checkpoint_dir, batch_number):
+        return os.path.join(checkpoint_dir, f"batch_{batch_number:06d}.npy")
+
+    # only removes the files this command writes, the directory goes too once it is empty
+    def clear_checkpoints(self, checkpoint_dir):
+        for path in glob.glob(os.path.join(checkpoint_dir, "batch_*.npy*")):
+            os.remove(path)
+        manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        try:
+            os.rmdir(checkpoint_dir)
+        except OSError:
+            pass
+
+    # returns the batch numbers that are already checkpointed and can be skipped
+    def prepare_checkpoints(self, checkpoint_dir, manifest, batch_count, resume):
+        manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+
+        if resume and os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                previous = json.load(file)
+            if previous != manifest:
+                raise CommandError(
+                    "Checkpoints in {} were made with different skills, model or batch size, "
+                    "rerun without --resume.".format(checkpoint_dir)
+                )
+            return {n for n in range(batch_count) if os.path.exists(self.batch_path(checkpoint_dir, n))}
+
+        # --checkpoint-dir may point anywhere, never take over a directory holding other files
+        if os.path.isdir(checkpoint_dir) and os.listdir(checkpoint_dir) and not os.path.exists(manifest_path):
+            raise CommandError(
+                f"{checkpoint_dir} is not empty and holds no rebuild checkpoints, pick another --checkpoint-dir."
+            )
+
+        self.clear_checkpoints(checkpoint_dir)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        with open(manifest_path, 'w') as file:
+            json.dump(manifest, file, indent=4)
+        return set()
@@ -1,3 +1,314 @@
 from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+import faiss
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from app1.gemini import CoalescingModel, QueueFullError
+from app1.management.commands import rebuild_skill_index
+
+
+# deterministic stand in for HuggingFaceEmbeddings, "skill 7" embeds to [7, 0, 0, 0]
+class FakeEmbeddings:
+    calls = 0
+
+    def __init__(self, model_name=None):
+        self.model_name = model_name
+
+    def embed_documents(self, texts):
+        FakeEmbeddings.calls += 1
+        return [[float(text.split()[1]), 0.0, 0.0, 0.0] for text in texts]
+
+
+class RebuildSkillIndexTests(TestCase):
+
+    def setUp(self):
+        FakeEmbeddings.calls = 0
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.app_dir = self.tmp_dir.name
+        self.output = os.path.join(self.app_dir, "rebuilt_index")
+        self.checkpoint_dir = os.path.join(self.app_dir, "checkpoints")
+
+        # skills deliberately not sorted by id, the index has to follow the json order
+        self.skill_numbers = [5, 2, 9, 0, 7, 3, 8, 1, 6, 4]
+        self.write_skills(self.skill_numbers)
+
+        for target, value in (("APP_DIR", self.app_dir), ("_load_embeddings", FakeEmbeddings)):
+            patcher = mock.patch.object(rebuild_skill_index, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_skills(self, numbers):
+        data = [{"skill_name": f"skill {n}", "skill_id": n} for n in numbers]
+        with open(os.path.join(self.app_dir, "applied_skills.json"), 'w') as file:
+            json.dump(data, file, indent=4)
+
+    def rebuild(self, *args, output=True):
+        args = ["applied", "--checkpoint-dir", self.checkpoint_dir, *args]
+        if output:
+            args += ["--output", self.output]
+        call_command("rebuild_skill_index", *args, stdout=StringIO())
+
+    def indexed_numbers(self, index_file):
+        index = faiss.read_index(index_file)
+        return [int(vector[0]) for vector in index.reconstruct_n(0, index.ntotal)]
+
+    def test_vectors_follow_json_order(self):
+        self.rebuild("--batch-size", "3", "--workers", "1")
+        self.assertEqual(self.indexed_numbers(self.output), self.skill_numbers)
+
+    def test_vectors_follow_json_order_with_process_pool(self):
+        # the patched embedder only reaches the workers when they are forked
+        if multiprocessing.get_start_method() != "fork":
+            self.skipTest("needs the fork start method")
+        self.rebuild("--batch-size", "3", "--workers", "2")
+        self.assertEqual(self.indexed_numbers(self.output), self.skill_numbers)
+
+    def test_resume_skips_checkpointed_batches(self):
+        self.rebuild("--batch-size", "3", "--keep-checkpoints")
+        self.assertEqual(FakeEmbeddings.calls, 4)
+
+        os.remove(os.path.join(self.checkpoint_dir, "batch_000002.npy"))
+        self.rebuild("--batch-size", "3", "--resume")
+
+        self.assertEqual(FakeEmbeddings.calls, 5)
+        self.assertEqual(self.indexed_numbers(self.output), self.skill_numbers)
+
+    def test_resume_with_other_model_fails(self):
+        self.rebuild("--batch-size", "3", "--keep-checkpoints")
+        with self.assertRaises(CommandError):
+            self.rebuild("--batch-size", "3", "--resume", "--model-name", "other-model")
+
+    def test_resume_with_other_batch_size_fails(self):
+        self.rebuild("--batch-size", "3", "--keep-checkpoints")
+        with self.assertRaises(CommandError):
+            self.rebuild("--batch-size", "4", "--resume")
+
+    def test_checkpoints_removed_after_rebuild(self):
+        self.rebuild("--batch-size", "3")
+        self.assertFalse(os.path.exists(self.checkpoint_dir))
+
+    def test_checkpoints_kept_when_asked(self):
+        self.rebuild("--batch-size", "3", "--keep-checkpoints")
+        self.assertTrue(os.path.exists(os.path.join(self.checkpoint_dir, "batch_000000.npy")))
+
+    def test_unrelated_files_in_checkpoint_dir_survive(self):
+        self.rebuild("--batch-size", "3", "--keep-checkpoints")
+        notes = os.path.join(self.checkpoint_dir, "notes.txt")
+        with open(notes, 'w') as file:
+            file.write("keep me")
+
+        self.rebuild("--batch-size", "3")
+
+        self.assertEqual(os.listdir(self.checkpoint_dir), ["notes.txt"])
+
+    def test_refuses_non_empty_dir_without_manifest(self):
+        os.makedirs(self.checkpoint_dir)
+        notes = os.path.join(self.checkpoint_dir, "notes.txt")
+        with open(notes, 'w') as file:
+            file.write("keep me")
+
+        with self.assertRaises(CommandError):
+            self.rebuild("--batch-size", "3")
+        self.assertEqual(os.listdir(self.checkpoint_dir), ["notes.txt"])
+
+    def test_live_index_not_replaced_when_json_changes(self):
+        live_index = os.path.join(self.app_dir, "applied_faiss_skills_index")
+        with open(live_index, 'w') as file:
+            file.write("old index")
+
+        write_skills = self.write_skills
+
+        # a skill gets deleted through the api while the rebuild is embedding
+        class DeletingEmbeddings(FakeEmbeddings):
+            def embed_documents(self, texts):
+                write_skills([5, 2, 9])
+                return super().embed_documents(texts)
+
+        with mock.patch.object(rebuild_skill_index, "_load_embeddings", DeletingEmbeddings):
+            with self.assertRaises(CommandError):
+                self.rebuild("--batch-size", "3", output=False)
+
+        with open(live_index, 'r') as file:
+            self.assertEqual(file.read(), "old index")
+
+
+# local stand in for the gemini model, every call blocks until release is set
+class FakeModel:
+
+    def __init__(self, error=None):
+        self.error = error
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.prompts = []
+        self.active = 0
+        self.max_active = 0
+
+    def generate_content(self, prompt, request_options=None):
+        with self.lock:
+            self.prompts.append(prompt)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        self.release.wait(5)
+        with self.lock:
+            self.active -= 1
+        if self.error is not None:
+            raise self.error
+        return f"response to {prompt}"
+
+
+class CoalescingModelTests(TestCase):
+
+    def setUp(self):
+        self.fake = FakeModel()
+        # calls are started from threads so several callers can wait at the same time
+        self.callers = ThreadPoolExecutor(max_workers=10)
+        self.addCleanup(self.callers.shutdown)
+
+    def coalescing_model(self, **kwargs):
+        kwargs.setdefault("timeout", 5)
+        model = CoalescingModel(self.fake, **kwargs)
+        self.addCleanup(model.executor.shutdown)
+        # cleanups run last in first out, unblock the fake before waiting on the executor
+        self.addCleanup(self.fake.release.set)
+        return model
+
+    def wait_until(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            if time.time() > deadline:
+                self.fail("condition not reached in time")
+            time.sleep(0.01)
+
+    def test_identical_prompts_share_one_call(self):
+        model = self.coalescing_model()
+        futures = [self.callers.submit(model.generate_content, "backend developer") for _ in range(5)]
+        self.wait_until(lambda: model.stats()["coalesced"] == 4)
+        self.fake.release.set()
+
+        self.assertEqual([f.result() for f in futures], ["response to backend developer"] * 5)
+        self.assertEqual(self.fake.prompts, ["backend developer"])
+        stats = model.stats()
+        self.assertEqual(stats["issued"], 1)
+        self.assertEqual(stats["coalesced"], 4)
+
+    def test_different_prompts_limited_by_max_concurrency(self):
+        model = self.coalescing_model(max_concurrency=2)
+        futures = [self.callers.submit(model.generate_content, f"job {n}") for n in range(5)]
+        self.wait_until(lambda: len(self.fake.prompts) == 2 and model.stats()["queued"] == 3)
+        self.fake.release.set()
+
+        for future in futures:
+            future.result()
+        self.assertEqual(len(self.fake.prompts), 5)
+        self.assertEqual(self.fake.max_active, 2)
+        self.assertEqual(model.stats()["issued"], 5)
+
+    def test_timeout(self):
+        model = self.coalescing_model()
+        with self.assertRaises(TimeoutError):
+            model.generate_content("data engineer", timeout=0.05)
+        self.assertEqual(model.stats()["timeouts"], 1)
+
+    def test_queued_call_cancelled_when_nobody_waits(self):
+        model = self.coalescing_model(max_concurrency=1)
+        running = self.callers.submit(model.generate_content, "data engineer")
+        self.wait_until(lambda: len(self.fake.prompts) == 1)
+
+        with self.assertRaises(TimeoutError):
+            model.generate_content("qa engineer", timeout=0.05)
+        self.fake.release.set()
+        running.result()
+
+        self.assertEqual(self.fake.prompts, ["data engineer"])
+        stats = model.stats()
+        self.assertEqual(stats["cancelled"], 1)
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_full_queue_rejects(self):
+        model = self.coalescing_model(max_concurrency=1, max_queue=1)
+        running = self.callers.submit(model.generate_content, "data engineer")
+        self.wait_until(lambda: len(self.fake.prompts) == 1)
+        queued = self.callers.submit(model.generate_content, "qa engineer")
+        self.wait_until(lambda: model.stats()["queued"] == 1)
+
+        with self.assertRaises(QueueFullError):
+            model.generate_content("designer")
+        # joining a call that is already queued does not need a new slot
+        coalesced = self.callers.submit(model.generate_content, "qa engineer")
+        self.wait_until(lambda: model.stats()["coalesced"] == 1)
+        self.fake.release.set()
+
+        self.assertEqual(coalesced.result(), queued.result())
+        running.result()
+        self.assertEqual(model.stats()["rejected"], 1)
+
+    def test_zero_queue_accepts_calls_while_slots_are_free(self):
+        model = self.coalescing_model(max_concurrency=2, max_queue=0)
+        first = self.callers.submit(model.generate_content, "data engineer")
+        second = self.callers.submit(model.generate_content, "qa engineer")
+        self.wait_until(lambda: len(self.fake.prompts) == 2)
+
+        with self.assertRaises(QueueFullError):
+            model.generate_content("designer")
+        self.fake.release.set()
+
+        first.result()
+        second.result()
+        self.assertEqual(model.generate_content("designer"), "response to designer")
+        self.assertEqual(model.stats()["rejected"], 1)
+
+    def test_upstream_gets_remaining_budget(self):
+        options = []
+        generate_content = self.fake.generate_content
+
+        def recording_generate_content(prompt, request_options=None):
+            options.append(request_options)
+            return generate_content(prompt, request_options)
+
+        self.fake.generate_content = recording_generate_content
+        model = self.coalescing_model(max_concurrency=1)
+        running = self.callers.submit(model.generate_content, "data engineer")
+        self.wait_until(lambda: len(self.fake.prompts) == 1)
+        queued = self.callers.submit(model.generate_content, "qa engineer", 5)
+        self.wait_until(lambda: model.stats()["queued"] == 1)
+        time.sleep(0.3)
+        self.fake.release.set()
+
+        running.result()
+        queued.result()
+        self.assertLess(options[1]["timeout"], 4.8)
+
+    def test_error_reaches_every_waiter(self):
+        self.fake.error = ValueError("quota exceeded")
+        model = self.coalescing_model()
+        futures = [self.callers.submit(model.generate_content, "backend developer") for _ in range(3)]
+        self.wait_until(lambda: model.stats()["coalesced"] == 2)
+        self.fake.release.set()
+
+        for future in futures:
+            with self.assertRaisesMessage(ValueError, "quota exceeded"):
+                future.result()
+        self.assertEqual(model.stats()["failures"], 1)
+
+    def test_finished_prompt_issues_fresh_call(self):
+        self.fake.release.set()
+        model = self.coalescing_model()
+        model.generate_content("backend developer")
+        model.generate_content("backend developer")
+
+        self.assertEqual(len(self.fake.prompts), 2)
+        stats = model.stats()
+        self.assertEqual(stats["issued"], 2)
+        self.assertEqual(stats["coalesced"], 0)
+        self.assertEqual(stats["in_flight"], 0)
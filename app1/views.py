@@ -9,8 +9,11 @@ import os
 import time
 from django.core.files.storage import default_storage
 import google.generativeai as genai
+from google.api_core.exceptions import DeadlineExceeded
 from pydparser import ResumeParser
 import re
+from django.conf import settings
+from .gemini import CoalescingModel, QueueFullError
 
 # Initialize HuggingFaceEmbeddings
 # importing the model from langchain_huggingface which will generate embedding for us
@@ -18,7 +21,13 @@ embeddings = HuggingFaceEmbeddings()
 genai.configure(api_key="")
 
 # Define the model
-model = genai.GenerativeModel("gemini-1.5-flash")
+# identical prompts in flight at the same time share one call, concurrent and queued calls are capped
+model = CoalescingModel(
+    genai.GenerativeModel("gemini-1.5-flash"),
+    max_concurrency=settings.GEMINI_MAX_CONCURRENCY,
+    timeout=settings.GEMINI_TIMEOUT,
+    max_queue=settings.GEMINI_MAX_QUEUE,
+)
 
 
 
@@ -317,6 +326,13 @@ class ApprovedSkillSearchView(APIView):
 
             return Response(response_data, status=status.HTTP_200_OK)
 
+        # our own timeout, or the client's request_options deadline firing first
+        except (TimeoutError, DeadlineExceeded) as e:
+            return Response({'error': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+
+        except QueueFullError as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -435,6 +451,14 @@ class ApprovedSkillSearchView(APIView):
 
 
 
+# for admin
+# counters of the gemini calls, coalesced vs issued upstream
+class GeminiStatsView(APIView):
+    def get(self, request):
+        return Response(model.stats(), status=status.HTTP_200_OK)
+
+
+
 # for user
 class ResumeParserView(APIView):
     def post(self, request):
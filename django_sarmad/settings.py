@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
      'rest_framework',
      'corsheaders',
+     'app1',
 ]
 
 MIDDLEWARE = [
@@ -127,3 +128,14 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Gemini calls
+# at most GEMINI_MAX_CONCURRENCY calls run at once and GEMINI_MAX_QUEUE more wait, further requests get a 503;
+# a call (queueing included) fails after GEMINI_TIMEOUT seconds
+
+GEMINI_MAX_CONCURRENCY = 4
+
+GEMINI_MAX_QUEUE = 16
+
+GEMINI_TIMEOUT = 30